@@ -4,7 +4,7 @@
 # # Simple health economic DES model with Python
 
 # A very simple model to serve as an exploration of creating health economic Discrete-Event Simulation (DES) models in
-# Python using SimPy library. The clinical context of the model is as follows:
+# Python. The clinical context of the model is as follows:
 # * During a cycle of treatment, patients can either die (p = 0.15) or experience a full cycle of treatment without any other events occurring.
 # * Patients can receive up to five cycles of treatment.
 # * A full cycle causes a longer delay or timeout compared to dying during a cycle. These timeouts are drawn from a Gamma distribution.
@@ -20,20 +20,19 @@
 # Note that the model currently only represents one comparator.
 # So for an actual cost-effectiveness analysis, another comparator must be added, but this is very straightforward.
 
-# Three classes are created for the model: 1) a class `g` contains all constants,
-# 2) a `Patient` class in which attributes of patients are set and 3) a `Model` class containing the model structure
-# and Patient Generator method. The model is run by creating an instance of `Model` and
+# Two classes are created for the model: 1) a class `g` contains all constants and 2) a `Model` class containing
+# the model structure. Because patients do not interact and all arrive at `t = 0`, the patients of one run are
+# simulated at once with NumPy arrays, in which each row is a patient and each column a treatment cycle, rather than
+# as individual SimPy processes. The model is run by creating an instance of `Model` and
 # subsequently executing the `run()` method of that `Model` instance. To accomodate the need to conduct multiple runs,
-# this is performed in a for loop.
+# the independent runs are divided over multiple processes with joblib.
 
-# Importing libraries and setting the random seed for reproducibility.
-import random
-from random import seed
+# Importing libraries and creating a seeded random number generator for reproducibility.
 import numpy as np
 import pandas as pd
-import simpy
+from joblib import Parallel, delayed
 
-seed(123)
+rng = np.random.default_rng(123)
 
 
 class g:
@@ -46,164 +45,195 @@ class g:
     u_treatment = 0.7
     u_followup = 0.8
     days_per_year = 365.2422
-    sim_duration = simpy.core.Infinity
     number_of_runs = 1
-
-
-class Patient:
-    def __init__(self, patient_id):
-        """Initializing attributes of Patients.
-        Of course these can be expanded to more accurately reflect patient heterogeneity."""
-        self.patient_id = patient_id
-        self.state = 'Alive'
-        self.treatment_cycles = 0
-        self.cost = 0
-        self.utility = 0
+    n_jobs = -1  # Number of processes to divide the runs over, -1 uses all CPU cores
+    verbose = False  # Also save the outcomes of every treatment cycle and followup in output_df
 
 
 class Model:
-    def __init__(self, run_number):
-        self.env = simpy.Environment()
-        self.patient_counter = 0
-        self.run_number = run_number
-
-    def generate_patients(self):
-        """The method that generates patients.
-        """
-        yield self.env.timeout(0)  # SimPy processes cannot be 'empty'
-        # Main generator loop that terminates when enough patients are simulated or
-        # when until is reached
-
-        self.run_number += 1
-        while self.env.now < g.sim_duration and self.patient_counter < g.n_patients:
-            self.patient_counter += 1
-            # Create a new instance of the Patient class
-            pat = Patient(patient_id=self.patient_counter)
+    # Categories of the phase output, which is stored as codes into this list
+    phases = ['treatment', 'followup']
 
-            # Use the SimPy environment and the enter_treatment and enter_followup methods
-            # with this patient
-            self.env.process(self.set_care_pathway(pat))
+    def __init__(self, run_number, deviates):
+        self.run_number = run_number
+        self.deviates = deviates  # Random deviates of this run, see the sampling before the run loop
+
+        self.summary = None  # Outcomes of interest per patient, set by set_care_pathway
+
+        # Preallocated, typed arrays to store the outcomes of interest of every cycle in, only used when g.verbose.
+        # They are large enough for the worst case (every patient completing every cycle and the followup phase)
+        # and are filled by set_care_pathway through the write cursor.
+        n_rows = g.n_patients * (g.max_cycles + 1) if g.verbose else 0
+        self.pid = np.empty(n_rows, np.int32)
+        self.alive = np.empty(n_rows, np.bool_)
+        self.cycle = np.empty(n_rows, np.int8)
+        self.phase = np.empty(n_rows, np.int8)
+        self.cost = np.empty(n_rows, np.float64)
+        self.util = np.empty(n_rows, np.float64)
+        self.t = np.empty(n_rows, np.float64)
+        self._w = 0
 
     def run(self):
-        self.env.process(self.generate_patients())
-        self.env.run(until=g.sim_duration)
+        self.run_number += 1
+        self.set_care_pathway()
+        return self.get_output()
 
         #################### START SECTION: MODEL STRUCTURE ####################
 
-    def set_care_pathway(self, patient):
-        """ Method that models the treatment phase.
+    def set_care_pathway(self):
+        """ Method that models the treatment and followup phase of all patients at once.
+        Rows of the arrays are patients, columns are treatment cycles.
         """
+        # Model constants are bound to local names once instead of being looked up on g repeatedly.
+        max_cycles = g.max_cycles
+        p_d = g.prob_death
+        c_d = g.c_treatment_daily
+        c_i = g.c_treatment_init
+        c_fu = g.c_followup
+        u_t = g.u_treatment
+        u_fu = g.u_followup
+        dpy = g.days_per_year
+
+        rand = self.deviates['rand']
+        time_to_death = self.deviates['death']
+        time_to_full_cycle = self.deviates['cycle']
+        time_in_followup = self.deviates['followup']
 
         #### TREATMENT PHASE ####
-        while patient.treatment_cycles < g.max_cycles and patient.state == 'Alive':
-            patient.treatment_cycles += 1
-
-            # First, the event that occurs during a cycle is determined.
-            rand = random.uniform(0, 1)
-            if rand < g.prob_death:
-                ##### EVENT: DEATH
-
-                # CHANGE PATIENT'S STATE TO DEAD
-                patient.state = 'Dead'
-
-                # SAMPLE A TIME-TO-EVENT
-                time_to_death = np.random.gamma(1.5, 3, 1)
+        # First, the event that occurs during each cycle is determined: EVENT: DEATH or EVENT: FULL CYCLE.
+        death = rand < p_d
 
-                # TIMEOUT EQUAL TO THE TIME-TO-EVENT
-                yield self.env.timeout(time_to_death)
+        # Patients receive cycles up to and including the first cycle in which they die.
+        died = death.any(axis=1)
+        cycles_received = np.where(died, np.argmax(death, axis=1) + 1, max_cycles)
+        received = np.arange(max_cycles) < cycles_received[:, None]
 
-                # INCREMENT ACCUMULATED COSTS AND UTILITY
-                patient.cost = self.increment_cost(patient, time_to_death)
-                patient.utility = self.increment_utility(time_to_death, g.u_treatment)
+        # SAMPLE A TIME-TO-EVENT, cycles that are not received take no time.
+        duration = np.where(death, time_to_death, time_to_full_cycle)
+        duration *= received
+        simulation_time = np.cumsum(duration, axis=1)
 
-            else:
-                ##### EVENT: FULL CYCLE
-                time_to_full_cycle = np.random.gamma(3, 10, 1)
-                yield self.env.timeout(time_to_full_cycle)
-                patient.cost = self.increment_cost(patient, time_to_full_cycle)
-                patient.utility = self.increment_utility(time_to_full_cycle, g.u_treatment)
-
-            # SAVE DATA AT THE END OF EACH CYCLE
-            self.save_data(patient, 'treatment')
+        # INCREMENT ACCUMULATED COSTS AND UTILITY
+        # The initial treatment costs only apply to the first cycle, so they are added as a per-cycle row vector.
+        c_init_lookup = np.where(np.arange(max_cycles) == 0, c_i, 0)
+        cost = duration * c_d + c_init_lookup
+        utility = duration * (u_t / dpy)
 
         #### FOLLOWUP PHASE ####
-        if patient.state == 'Alive':
-            time_in_folllowup = np.random.gamma(2, 15, 1)
-            yield self.env.timeout(time_in_folllowup)
-            patient.utility = self.increment_utility(time_in_folllowup, g.u_followup)
-            patient.cost = g.c_followup
-            self.save_data(patient, 'followup')
-
-            #################### END SECTION: MODEL STRUCTURE ####################
+        survived = ~died
+        followup_time = np.where(survived, time_in_followup, 0)
+
+        # SAVE THE SUMMARY OF EACH PATIENT
+        self.summary = {'patient_id': np.arange(1, len(death) + 1, dtype=np.int32),
+                        'run_number': np.full(len(death), self.run_number, np.int32),
+                        'cost': cost.sum(axis=1) + np.where(survived, c_fu, 0),
+                        'utility': utility.sum(axis=1) + followup_time * (u_fu / dpy),
+                        'treatment_cycles_rec': cycles_received.astype(np.int8),
+                        'simulation_time': simulation_time[:, -1] + followup_time,
+                        'alive': survived}
+
+        if g.verbose:
+            # SAVE DATA AT THE END OF EACH CYCLE
+            patient_idx, cycle_idx = np.nonzero(received)
+            i = self._w
+            j = i + len(patient_idx)
+            self.pid[i:j] = patient_idx + 1
+            self.alive[i:j] = ~death[patient_idx, cycle_idx]
+            self.cycle[i:j] = cycle_idx + 1
+            self.phase[i:j] = 0  # treatment
+            self.cost[i:j] = cost[patient_idx, cycle_idx]
+            self.util[i:j] = utility[patient_idx, cycle_idx]
+            self.t[i:j] = simulation_time[patient_idx, cycle_idx]
+
+            # SAVE DATA AT THE END OF FOLLOWUP
+            survivors = np.flatnonzero(survived)
+            i = j
+            j = i + len(survivors)
+            self.pid[i:j] = survivors + 1
+            self.alive[i:j] = True
+            self.cycle[i:j] = max_cycles
+            self.phase[i:j] = 1  # followup
+            self.cost[i:j] = c_fu
+            self.util[i:j] = time_in_followup[survivors] * (u_fu / dpy)
+            self.t[i:j] = simulation_time[survivors, -1] + time_in_followup[survivors]
+            self._w = j
+
+        #################### END SECTION: MODEL STRUCTURE ####################
 
     #################### START SECTION: HELPER METHODS ####################
 
-    def save_data(self, patient, phase):
-        """Append a list of outcomes of interest as specified here to a list that
-        is created outside the Patient class. This method should be called whenever it
-        is appropriate to save data. E.g., each treatment cycle.
-        Note, appending a list to a list and converting the final list once to a dataframe is much more efficient
-        than appending directly to a pd dataframe."""
-        output_list.append(
-            [patient.patient_id, patient.state, patient.treatment_cycles, phase, patient.cost, patient.utility,
-             self.run_number, self.env.now])
-
-    @staticmethod
-    def increment_cost(patient, duration):
-        """Helper method to increment the cost attribute of Patient"""
-        cost_increment = int(duration) * g.c_treatment_daily
-        if patient.treatment_cycles == 1:
-            cost_increment += g.c_treatment_init
-        return cost_increment
-
-    @staticmethod
-    def increment_utility(duration, utility):
-        """Helper method to increment the utility attribute of Patient"""
-        utility_increment = duration * (utility / g.days_per_year)
-        return utility_increment
+    def get_output(self):
+        """Return the outcomes of interest of this run as a tuple of two dictionaries of column arrays: the summary
+        with one row per patient and, when g.verbose, the saved data with one row per cycle (otherwise None).
+        The state of patients is stored as a boolean and the phase as a code into Model.phases.
+        Only the filled part of the preallocated output arrays is returned."""
+        if not g.verbose:
+            return self.summary, None
+        n = self._w
+        return self.summary, {'patient_id': self.pid[:n],
+                              'alive': self.alive[:n],
+                              'treatment_cycle': self.cycle[:n],
+                              'phase': self.phase[:n],
+                              'cost': self.cost[:n],
+                              'utility': self.util[:n],
+                              'run_number': np.full(n, self.run_number, np.int32),
+                              'simulation_time': self.t[:n]}
 
     #################### END SECTION: HELPER METHODS ####################
 
 
-# Empty list to store outcomes of interest in. Used by the Patient.save_data() method.
-output_list = []
+def run_one(run_number, deviates):
+    """Run the model once and return the outcomes of interest of that run. Runs are independent of each other,
+    so they can be divided over multiple processes."""
+    return Model(run_number, deviates).run()
 
-# Running the model for the required amount of runs and printing progress.
-for run in range(g.number_of_runs):
-    print("Run ", run + 1, " of ", g.number_of_runs, sep="")
-    my_model = Model(run)
-    my_model.run()
-    print()
 
-output_df = pd.DataFrame(output_list,
-                         columns=['patient_id', 'state', 'treatment_cycle', 'phase', 'cost', 'utility', 'run_number',
-                                  'simulation_time'])
-output_df[['utility', 'simulation_time']] = output_df[['utility', 'simulation_time']].astype(float)
-# print(output_df)
+# Sampling the random deviates of all runs at once, as their distributions are the same for every run.
+# Each run receives its own (n_patients, max_cycles) slice.
+deviates_shape = (g.number_of_runs, g.n_patients, g.max_cycles)
+deviates = {'rand': rng.random(deviates_shape),
+            'death': rng.gamma(1.5, 3, deviates_shape),
+            'cycle': rng.gamma(3, 10, deviates_shape),
+            'followup': rng.gamma(2, 15, deviates_shape[:2])}
 
-print(output_df.loc[output_df['patient_id'] == 7])
+# Running the model for the required amount of runs in parallel.
+print("Running ", g.number_of_runs, " run(s)", sep="")
+results = Parallel(n_jobs=g.n_jobs)(
+    delayed(run_one)(run, {name: draws[run] for name, draws in deviates.items()})
+    for run in range(g.number_of_runs))
+print()
 
-# Transform the dataframe so that one row equals one patient where:
-# Costs and utility are summed, simulation_time equals the latest simulation_time,
-# State equals the final value of state, and treatment cycle equals the maximum value
+summaries, outputs = zip(*results)
 
-# summary_df = output_df.loc[output_df.groupby('patient_id')['simulation_time'].idxmax()]
-summary_df = pd.DataFrame()
-summary_df[['patient_id', 'state', 'treatment_cycles_rec', 'simulation_time']] = \
-    output_df[['patient_id', 'state', 'treatment_cycle', 'simulation_time']].loc[
-        output_df.groupby(['patient_id', 'run_number'])['simulation_time'].idxmax()]
 
+def concatenate_runs(run_columns):
+    """Concatenate the column arrays of all runs once and convert them to a dataframe,
+    where the state and phase codes become categorical columns."""
+    columns = {}
+    for column in run_columns[0]:
+        values = np.concatenate([run[column] for run in run_columns])
+        if column == 'alive':
+            columns['state'] = pd.Categorical.from_codes((~values).astype(np.int8), categories=['Alive', 'Dead'])
+        elif column == 'phase':
+            columns['phase'] = pd.Categorical.from_codes(values, categories=Model.phases)
+        else:
+            columns[column] = values
+    return pd.DataFrame(columns)
 
-# Function to sum costs and utility for each patient
-def calculate_on_group(x):
-    return pd.Series(x.sum(), index=x.index)
 
-
-summary_df['cost'] = output_df.groupby(['patient_id', 'run_number'])['cost'].apply(calculate_on_group)
-summary_df['utility'] = output_df.groupby(['patient_id', 'run_number'])['utility'].apply(calculate_on_group)
+# The summary has one row per patient where:
+# Costs and utility are summed, simulation_time equals the latest simulation_time,
+# State equals the final value of state, and treatment cycle equals the maximum value
+summary_df = concatenate_runs(summaries)
 
 summary_df.head(n=10)
 
+if g.verbose:
+    output_df = concatenate_runs(outputs)
+    # print(output_df)
+
+    print(output_df.loc[output_df['patient_id'] == 7])
+
 print(summary_df[['cost', 'utility', 'treatment_cycles_rec']].describe())
 
 # # Checking distributions
@@ -213,7 +243,7 @@ print(summary_df[['cost', 'utility', 'treatment_cycles_rec']].describe())
 
 # shape = 1.5
 # scale = 3
-# x = np.random.gamma(shape, scale, 10000)
+# x = rng.gamma(shape, scale, 10000)
 
 # count, bins, ignored = plt.hist(x, 50, density=True)
 # y = bins**(shape-1)*(np.exp(-bins/scale) /